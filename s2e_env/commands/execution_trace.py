@@ -69,10 +69,7 @@ def _make_json_entry(header, item, state):
     elif header.type == TraceEntries_pb2.TRACE_MOD_LOAD:
         state.modules.add(Module(item))
     elif header.type == TraceEntries_pb2.TRACE_MOD_UNLOAD:
-        try:
-            state.modules.remove(Module(item))
-        except Exception:
-            pass
+        state.modules.remove(Module(item))
 
     header_dict = protobuf_to_dict(header, use_enum_labels=True)
 
@@ -75,7 +75,7 @@ class ForkProfiler:
             counts[rel_pc] += 1
 
     def get(self):
-        analyzer = Analyzer(self._trace, self._trace_cb)
+        analyzer = Analyzer(self._trace, self._trace_cb, {TraceEntries_pb2.TRACE_FORK})
         analyzer.walk_tree()
 
     def get_profile(self):
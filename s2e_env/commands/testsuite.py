@@ -20,11 +20,12 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime
+import functools
 import logging
-import multiprocessing
-import multiprocessing.dummy
 import os
+import re
 import signal
 import stat
 import subprocess
@@ -34,13 +35,13 @@ import time
 import yaml
 
 import psutil
-import sh
 
 from s2e_env import CONSTANTS
 from s2e_env.command import EnvCommand, CommandError
 from s2e_env.manage import call_command
 from s2e_env.commands.new_project import target_from_file
 from s2e_env.commands.project_creation.abstract_project import validate_arguments
+from s2e_env.commands.project_creation.target import Target
 from s2e_env.commands.run import send_signal_to_children_on_exit
 from s2e_env.utils.images import get_image_templates, get_app_templates, get_all_images, get_image_descriptor, \
                                  select_guestfs, translate_image_name
@@ -48,15 +49,18 @@ from s2e_env.utils.templates import render_template
 
 logger = logging.getLogger('testsuite')
 
+# Matches a plain variable substitution, e.g. ``{{ project_name }}``
+_VARIABLE_REGEX = re.compile(r'{{\s*([A-Za-z_]\w*)\s*}}')
+
 
 def _get_tests(testsuite_root):
     tests = []
 
-    for fn in os.listdir(testsuite_root):
-        path = os.path.join(testsuite_root, fn)
-        if fn.startswith('.') or not os.path.isdir(path):
-            continue
-        tests.append(fn)
+    with os.scandir(testsuite_root) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            tests.append(entry.name)
 
     return tests
 
@@ -64,18 +68,23 @@ def _get_tests(testsuite_root):
 def _get_run_test_scripts(testsuite_root):
     tests = []
 
-    for test_name in os.listdir(testsuite_root):
-        for test_project in os.listdir(os.path.join(testsuite_root, test_name)):
-            path = os.path.join(testsuite_root, test_name, test_project)
-            if not os.path.isdir(path):
+    with os.scandir(testsuite_root) as test_entries:
+        for test_entry in test_entries:
+            if not test_entry.is_dir():
                 continue
 
-            run_tests_path = os.path.join(testsuite_root, path, 'run-tests')
-            if not os.path.exists(run_tests_path):
-                logger.warning('%s does not exist, skipping test project %s/%s',
-                               run_tests_path, test_name, test_project)
+            with os.scandir(test_entry.path) as project_entries:
+                for project_entry in project_entries:
+                    if not project_entry.is_dir():
+                        continue
+
+                    run_tests_path = os.path.join(project_entry.path, 'run-tests')
+                    if not os.path.isfile(run_tests_path):
+                        logger.warning('%s does not exist, skipping test project %s/%s',
+                                       run_tests_path, test_entry.name, project_entry.name)
+                        continue
 
-            tests.append(run_tests_path)
+                    tests.append(run_tests_path)
 
     return tests
 
@@ -87,8 +96,12 @@ def _build_test(s2e_config, s2e_source_root, test_root):
     env['S2ESRC'] = s2e_source_root
     env['WINDOWS_BUILD_HOST'] = s2e_config.get('windows_build_server', {}).get('host', '')
     env['WINDOWS_BUILD_USER'] = s2e_config.get('windows_build_server', {}).get('user', '')
-    make = sh.Command('make').bake('-C', test_root, 'all', _out=sys.stdout, _err=sys.stderr, _env=env)
-    make()
+    # make only rebuilds the targets that are out of date, there is no need
+    # to check whether the test changed here
+    try:
+        subprocess.check_call(['make', '-C', test_root, 'all'], env=env, stdout=sys.stdout, stderr=sys.stderr)
+    except subprocess.CalledProcessError as e:
+        raise CommandError(f'Could not build {test_root}') from e
 
 
 def _read_config(test_root, s2e_images_root):
@@ -114,8 +127,10 @@ def _call_post_project_gen_script(test_dir, test_config, options):
     env['TARGET'] = options['target'].path
     env['TESTSUITE_ROOT'] = options['testsuite_root']
 
-    cmd = sh.Command(script).bake(_out=sys.stdout, _err=sys.stderr, _env=env)
-    cmd()
+    try:
+        subprocess.check_call([script], env=env, stdout=sys.stdout, stderr=sys.stderr)
+    except subprocess.CalledProcessError as e:
+        raise CommandError(f'{script} failed with exit code {e.returncode}') from e
 
 
 def _resolve_target_path(test_root, target_name, guestfs_dirs):
@@ -132,6 +147,19 @@ def _resolve_target_path(test_root, target_name, guestfs_dirs):
     return ret
 
 
+# The same target is usually used for several images and argument batches
+@functools.lru_cache(maxsize=256)
+def _analyze_target(target_path):
+    target, proj_class = target_from_file(target_path)
+    return target.arch, target.operating_system, tuple(target.aux_files), proj_class
+
+
+def _create_target(target_path, args):
+    # Targets are modified by project creation, each project needs its own
+    arch, op_sys, aux_files, proj_class = _analyze_target(target_path)
+    return Target(target_path, args, arch, op_sys, list(aux_files)), proj_class
+
+
 def _need_target_path_resolution(test_config):
     for target_name in test_config['targets']:
         if '$(GUEST_FS)' in target_name:
@@ -162,6 +190,44 @@ def _parse_target_arguments(test_root, test_config):
     return processed_batches
 
 
+@functools.lru_cache(maxsize=256)
+def _get_simple_template(template_path):
+    """
+    Return the source of the template if it only substitutes plain variables.
+    """
+    # Text mode normalizes line endings, like Jinja
+    try:
+        with open(template_path, 'r', encoding='utf-8') as fp:
+            source = fp.read()
+    except OSError:
+        return None
+
+    if '{%' in source or '{##' in source or '{{' in _VARIABLE_REGEX.sub('', source):
+        return None
+
+    # Jinja drops a single trailing newline
+    if source.endswith('\n'):
+        source = source[:-1]
+
+    return source
+
+
+def _render_run_tests(ts_dir, template, ctx):
+    # Most run-tests templates only substitute a few variables, which does not
+    # require Jinja. Jinja still reports the variables missing from ctx.
+    source = _get_simple_template(os.path.join(ts_dir, template))
+    if source is not None:
+        try:
+            rendered_data = _VARIABLE_REGEX.sub(lambda m: str(ctx[m.group(1)]), source)
+        except KeyError:
+            pass
+        else:
+            # Remove trailing spaces, like render_template
+            return '\n'.join(line.rstrip() for line in rendered_data.splitlines())
+
+    return render_template(ctx, template, templates_dir=ts_dir)
+
+
 class TestsuiteGenerator(EnvCommand):
     def __init__(self):
         super().__init__()
@@ -193,7 +259,7 @@ class TestsuiteGenerator(EnvCommand):
         }
 
         run_tests_template = f'{test}/{script_template}'
-        run_tests = render_template(ctx, run_tests_template, templates_dir=ts_dir)
+        run_tests = _render_run_tests(ts_dir, run_tests_template, ctx)
 
         run_tests_path = os.path.join(self.projects_path(options['name']), 'run-tests')
         with open(run_tests_path, 'w', encoding='utf-8') as fp:
@@ -222,9 +288,7 @@ class TestsuiteGenerator(EnvCommand):
         return True
 
     # pylint: disable=too-many-locals,too-many-branches,too-many-statements
-    def _handle_test(self, test_root, test, test_config):
-        ts_dir = self.source_path('s2e', 'testsuite')
-
+    def _handle_test(self, ts_dir, test_root, test, test_config):
         if os.path.exists(os.path.join(test_root, 'Makefile')):
             _build_test(self._config, self.source_path('s2e'), test_root)
 
@@ -249,8 +313,7 @@ class TestsuiteGenerator(EnvCommand):
 
                     arg_batches = _parse_target_arguments(test_root, test_config)
                     for arg_idx, arg_batch in enumerate(arg_batches):
-                        target, proj_class = target_from_file(target_path)
-                        target.args = arg_batch
+                        target, proj_class = _create_target(target_path, arg_batch)
                         project = proj_class()
 
                         self._gen_project(
@@ -262,23 +325,27 @@ class TestsuiteGenerator(EnvCommand):
                 target_path = _resolve_target_path(test_root, target_name, [])
                 arg_batches = _parse_target_arguments(test_root, test_config)
 
+                # The usable images only depend on the binary, not on its arguments
+                target, proj_class = _create_target(target_path, None)
+                images = proj_class().get_usable_images(target, self._img_templates)
+                logger.info(images)
+
+                # Filter the images once instead of checking target-images for every image
+                if target_images:
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug('Skipping images that are not in target-images: %s',
+                                     [i for i in images if i not in target_images])
+                    images = [i for i in images if i in target_images]
+
                 for arg_idx, args in enumerate(arg_batches):
-                    target, proj_class = target_from_file(target_path)
-                    target.args = args
+                    target, proj_class = _create_target(target_path, args)
                     project = proj_class()
 
-                    images = project.get_usable_images(target, self._img_templates)
-                    logger.info(images)
-
                     for image_name in images:
                         if image_name in blacklisted_images:
                             logger.warning('%s is blacklisted, skipping tests for that image', image_name)
                             continue
 
-                        if target_images and image_name not in target_images:
-                            logger.debug('%s is not in target-images, skipping', image_name)
-                            continue
-
                         self._gen_project(
                             ts_dir, test_config, test_root, test, target,
                             target_path, image_name, project, arg_idx
@@ -322,6 +389,10 @@ class TestsuiteGenerator(EnvCommand):
     def handle(self, *args, **options):
         logger.info('Generating testsuite...')
         self._cmd_options = options
+
+        # Binaries may have been rebuilt since the last time this command ran
+        _analyze_target.cache_clear()
+
         self._initialize_images()
 
         ts_dir = self.source_path('s2e', 'testsuite')
@@ -337,7 +408,7 @@ class TestsuiteGenerator(EnvCommand):
             if not self._must_generate_test(test, test_config):
                 continue
 
-            self._handle_test(test_root, test, test_config)
+            self._handle_test(ts_dir, test_root, test, test_config)
 
 
 class TestsuiteLister(EnvCommand):
@@ -363,18 +434,30 @@ class TestsuiteLister(EnvCommand):
             logger.info('%-25s: %s', test, config['description'])
 
 
-def _get_max_instances(**options):
+def _get_resources():
+    return psutil.cpu_count(), psutil.virtual_memory().available
+
+
+def _get_max_instances(mem_usages, resources, **options):
     if not options.get('instances', 0):
         # Determine optimal number of cores based on available memory
-        cpus = psutil.cpu_count()
-        mem = psutil.virtual_memory().available
+        cpus, mem = resources
 
         if options.get('log', True):
             logger.info('The system has %d CPUs and %d GB of available RAM', cpus, mem / (1 << 30))
             logger.info('Average memory usage per S2E instance: %d GB',
-                        TestsuiteRunner.AVERAGE_S2E_MEM_USAGE / (1 << 30))
-        max_instances = int(mem / TestsuiteRunner.AVERAGE_S2E_MEM_USAGE)
-        return min(cpus, max_instances)
+                        sum(mem_usages) / max(len(mem_usages), 1) / (1 << 30))
+
+        # Packing the smallest tests first gives an upper bound on the number
+        # of instances that can run at the same time
+        max_instances = 0
+        for mem_usage in sorted(mem_usages):
+            if mem_usage > mem:
+                break
+            mem -= mem_usage
+            max_instances += 1
+
+        return max(1, min(cpus, max_instances))
 
     return options.get('instances')
 
@@ -388,17 +471,48 @@ class TestCancelledException(Exception):
     pass
 
 
-def _throttle(state):
+def _reserve_memory(state, mem_usage):
+    budget = state.get('mem_budget')
+    if not budget:
+        return True
+
+    cond = state.get('mem_cond')
+    with cond:
+        while state['reserved_mem'] and state['reserved_mem'] + mem_usage > budget:
+            if state.get('terminating', False):
+                return False
+            cond.wait(timeout=1)
+
+        state['reserved_mem'] += mem_usage
+
+    return True
+
+
+def _release_memory(state, mem_usage):
+    if not state.get('mem_budget'):
+        return
+
+    cond = state.get('mem_cond')
+    with cond:
+        state['reserved_mem'] -= mem_usage
+        cond.notify_all()
+
+
+def _throttle(state, mem_usage):
     # We don't enforce memory limits, best effort to avoid crashing the machine.
     while _get_mem_free_percentage() < 10 and not state.get('terminating'):
         logger.info('Not enough memory to start a new instance. Waiting.')
         time.sleep(10)
 
+    if not _reserve_memory(state, mem_usage):
+        return False
+
     # Prevent all instances from starting at the same time
     lock = state.get('start_lock')
 
     while not lock.acquire(timeout=1):
         if state.get('terminating', False):
+            _release_memory(state, mem_usage)
             return False
 
     time.sleep(0.5)
@@ -413,13 +527,21 @@ class TestsuiteRunner(EnvCommand):
 
     AVERAGE_S2E_MEM_USAGE = 3 * 1024 * 1024 * 1024
 
-    def call_script(self, state, script):
-        if not _throttle(state):
+    @staticmethod
+    def call_script(state, script, env, mem_usage):
+        if not _throttle(state, mem_usage):
             return
 
+        # The memory reserved by _throttle must be released whatever happens,
+        # otherwise the other scripts could wait for it forever
+        try:
+            TestsuiteRunner._run_script(state, script, env)
+        finally:
+            _release_memory(state, mem_usage)
+
+    @staticmethod
+    def _run_script(state, script, env):
         logger.info('Starting %s', script)
-        env = os.environ.copy()
-        env['S2EDIR'] = self.env_path()
 
         stdout = os.path.join(os.path.dirname(script), 'stdout.txt')
         stderr = os.path.join(os.path.dirname(script), 'stderr.txt')
@@ -468,13 +590,34 @@ class TestsuiteRunner(EnvCommand):
                             logger.error('   Check %s for details', stdout)
                             logger.error('   Check %s for details', stderr)
 
-    # pylint: disable=too-many-locals
-    def handle(self, *args, **options):
-        logger.info('Running testsuite')
+    def _get_test_mem_usage(self, test):
+        test_root = self.source_path('s2e', 'testsuite', test)
+        if not os.path.exists(os.path.join(test_root, 'config.yml')):
+            return self.AVERAGE_S2E_MEM_USAGE
 
-        actual_instances = _get_max_instances(**options)
+        test_config = _read_config(test_root, self.image_path())
+        mem_limit = test_config.get('memory_limit_mb')
+        if not mem_limit:
+            return self.AVERAGE_S2E_MEM_USAGE
 
-        logger.info('Running %d tests in parallel', actual_instances)
+        return mem_limit * 1024 * 1024
+
+    def _get_mem_usages(self, scripts):
+        tests_mem_usage = {}
+        mem_usages = {}
+
+        for script in scripts:
+            # Scripts are located in projects/testsuite/<test>/<project>/run-tests
+            test = os.path.basename(os.path.dirname(os.path.dirname(script)))
+            if test not in tests_mem_usage:
+                tests_mem_usage[test] = self._get_test_mem_usage(test)
+            mem_usages[script] = tests_mem_usage[test]
+
+        return mem_usages
+
+    # pylint: disable=too-many-locals,too-many-branches
+    def handle(self, *args, **options):
+        logger.info('Running testsuite')
 
         # Compute the tests to run
         test_scripts = _get_run_test_scripts(self.projects_path('testsuite'))
@@ -510,9 +653,20 @@ class TestsuiteRunner(EnvCommand):
                 continue
             scripts_to_run.append(script)
 
+        # Start the most memory-hungry tests first, so that they do not end up
+        # running alone at the end
+        mem_usages = self._get_mem_usages(scripts_to_run)
+        scripts_to_run.sort(key=lambda script: mem_usages[script], reverse=True)
+
+        resources = _get_resources()
+        actual_instances = _get_max_instances(list(mem_usages.values()), resources, **options)
+
+        logger.info('Running %d tests in parallel', actual_instances)
+
         send_signal_to_children_on_exit(signal.SIGKILL)
 
-        pool = multiprocessing.dummy.Pool(actual_instances)
+        # All the scripts share the same environment
+        env = {**os.environ, 'S2EDIR': self.env_path()}
 
         state = {
             'completed': 0,
@@ -520,26 +674,40 @@ class TestsuiteRunner(EnvCommand):
             'start_lock': threading.Lock(),
             'print_lock': threading.Lock(),
             'terminating': False,
-        }
-
-        original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-        signal.signal(signal.SIGINT, original_sigint_handler)
 
-        try:
-            r = [pool.apply_async(self.call_script, (state, script,)) for script in scripts_to_run]
+            # When the number of instances is computed automatically, only start
+            # a test if its estimated memory usage fits in the available memory
+            'mem_budget': None if options.get('instances') else resources[1],
+            'mem_cond': threading.Condition(),
+            'reserved_mem': 0,
+        }
 
-            # This works around a bug in Python 2.7, which prevents pool.join() from
-            # being interrupted by ctrl + c.
-            for item in r:
-                item.wait(timeout=9999999)
+        errors = 0
 
-        except KeyboardInterrupt:
-            logger.warning('Terminating testsuite (CTRL+C)')
-            state['terminating'] = True
-            pool.terminate()
-        finally:
-            pool.close()
-            pool.join()
+        # The scripts spend their time waiting on S2E subprocesses, so threads are enough here
+        with ThreadPoolExecutor(max_workers=actual_instances) as executor:
+            futures = {}
+            try:
+                for script in scripts_to_run:
+                    futures[executor.submit(self.call_script, state, script, env, mem_usages[script])] = script
+                for future in as_completed(futures):
+                    # Keep running the other scripts if one of them could not be started
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error('Could not run %s: %s', futures[future], e)
+                        errors += 1
+            except KeyboardInterrupt:
+                logger.warning('Terminating testsuite (CTRL+C)')
+                state['terminating'] = True
+
+                # Drop the scripts that did not start yet, the running ones
+                # stop by themselves once they see the terminating flag
+                for future in futures:
+                    future.cancel()
+
+        if errors:
+            raise CommandError(f'{errors} test scripts could not be run')
 
 
 class Command(EnvCommand):
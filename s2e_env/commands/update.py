@@ -41,19 +41,28 @@ class Command(EnvCommand):
 
     help = 'Updates the S2E repos.'
 
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+
+        parser.add_argument('-j', '--jobs', type=int, default=None,
+                            help='Number of repositories to fetch in '
+                                 'parallel (default: the value from the '
+                                 'repo manifest)')
+
     def handle(self, *args, **options):
-        self._update_s2e_sources()
+        self._update_s2e_sources(options['jobs'])
         logger.success('Environment updated. Now run ``s2e build`` to rebuild')
 
-    def _update_s2e_sources(self):
+    def _update_s2e_sources(self, jobs):
         """
         Update all of the S2E repositories with repo.
+
+        The repositories are independent, so ``jobs`` of them are fetched
+        concurrently. If ``jobs`` is not given, repo uses the value from the
+        manifest.
         """
         repo = sh.Command(self.install_path('bin', 'repo'))
 
-        # cd into the S2E source directory
-        orig_dir = os.getcwd()
-
         repo_dir = self.source_path('.repo')
         if not os.path.exists(repo_dir):
             raise CommandError(
@@ -61,16 +70,12 @@ class Command(EnvCommand):
                 'Please create a new environment.'
             )
 
-        os.chdir(self.source_path())
-
         try:
             logger.info('Updating S2E')
-            repo.sync(_out=sys.stdout, _err=sys.stderr)
+            sync_args = [f'--jobs={jobs}'] if jobs else []
+            repo.sync(*sync_args, _out=sys.stdout, _err=sys.stderr, _cwd=self.source_path())
         except ErrorReturnCode as e:
             raise CommandError(e) from e
-        finally:
-            # Change back to the original directory
-            os.chdir(orig_dir)
 
         # Success!
         logger.info('Updated S2E')
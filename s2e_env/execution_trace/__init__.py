@@ -21,10 +21,19 @@ SOFTWARE.
 """
 
 
-import glob
+import array
+import collections
+import collections.abc
+import copy
+from concurrent.futures import ProcessPoolExecutor
+import functools
 import logging
+import mmap
 import os
 import struct
+import sys
+
+from google.protobuf.internal import api_implementation
 
 from s2e_env.execution_trace import TraceEntries_pb2
 
@@ -33,6 +42,19 @@ logger = logging.getLogger('execution_trace')
 _HEADER_PREFIX = struct.Struct('<II')
 _INTEGER = struct.Struct('<I')
 
+# Bound once, as they are called for every trace entry
+_unpack_header_prefix = _HEADER_PREFIX.unpack_from
+_unpack_integer = _INTEGER.unpack_from
+_HEADER_PREFIX_SIZE = _HEADER_PREFIX.size
+_INTEGER_SIZE = _INTEGER.size
+
+# Whether the pure-Python protobuf implementation was already reported
+_protobuf_implementation_logged = False
+
+# Trace files smaller than this are read into memory at once, larger ones
+# are memory-mapped
+_MAX_READ_SIZE = 512 * 1024 * 1024
+
 # Maps trace entry types to a class
 _TRACE_ENTRY_MAP = {
     TraceEntries_pb2.TRACE_FORK: TraceEntries_pb2.PbTraceItemFork,
@@ -55,6 +77,18 @@ _TRACE_ENTRY_MAP = {
     TraceEntries_pb2.TRACE_CFI_VIOLATION: TraceEntries_pb2.PbTraceCfiViolation,
 }
 
+# Same as ``_TRACE_ENTRY_MAP``, but indexed directly by the entry type.
+# Unknown types map to ``None``
+_TRACE_ENTRY_TABLE = tuple(_TRACE_ENTRY_MAP.get(t) for t in range(max(_TRACE_ENTRY_MAP) + 1))
+
+# Entries whose items are always inspected when walking the execution tree.
+# Decoding them lazily would only add overhead.
+_EAGER_TYPES = frozenset({
+    TraceEntries_pb2.TRACE_MOD_LOAD,
+    TraceEntries_pb2.TRACE_MOD_UNLOAD,
+    TraceEntries_pb2.TRACE_OSINFO,
+})
+
 
 class TraceEntryFork:
     """
@@ -67,6 +101,338 @@ class TraceEntryFork:
         self.children = children
 
 
+class LazyTraceEntry:
+    """
+    A trace item that is only decoded when one of its fields is first
+    accessed. Many clients only look at the entry header, in which case the
+    item is never decoded.
+
+    The entry otherwise behaves like the decoded item: it passes the same
+    ``isinstance`` checks, compares equal to it, and copying or pickling it
+    produces the decoded item.
+    """
+    __slots__ = ('_item_class', '_raw_item', '_item')
+
+    def __init__(self, item_class, raw_item):
+        self._item_class = item_class
+        self._raw_item = raw_item
+        self._item = None
+
+    def __getattr__(self, name):
+        # Only called for the attributes of the item, as the slots above are
+        # found by the normal attribute lookup. Special names and unset slots
+        # are not forwarded: copy and pickle probe for them before the slots
+        # are set, and decoding would then recurse forever.
+        if name.startswith('__') or name in LazyTraceEntry.__slots__:
+            raise AttributeError(name)
+
+        return getattr(self._decode(), name)
+
+    @property
+    def __class__(self):
+        return self._item_class
+
+    def __eq__(self, other):
+        if isinstance(other, LazyTraceEntry):
+            other = other._decode()
+
+        return self._decode() == other
+
+    # Like protobuf messages, which are mutable
+    __hash__ = None
+
+    def __copy__(self):
+        return copy.copy(self._decode())
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self._decode(), memo)
+
+    def __reduce__(self):
+        # The raw item is a view on the trace file, which cannot be pickled
+        return self._decode().__reduce__()
+
+    def __repr__(self):
+        return repr(self._decode())
+
+    def __str__(self):
+        return str(self._decode())
+
+    def _decode(self):
+        item = self._item
+        if item is None:
+            item = self._item = self._item_class()
+            item.ParseFromString(self._raw_item)
+            self._raw_item = None
+
+        return item
+
+
+def _read_trace_entry(buf, offset, forks_only=False, header=None, lazy=False):
+    """
+    Read the trace entry located at ``offset`` in ``buf``.
+
+    Returns a ``(header, item, next_offset)`` tuple. ``item`` is ``None`` if
+    the entry has an unknown type, in which case its body is skipped. If
+    ``forks_only`` is set, only fork items are parsed and ``item`` is ``None``
+    for the other entries. If ``lazy`` is set, items that are not always
+    needed are returned as a ``LazyTraceEntry``.
+
+    If ``header`` is given, the entry header is decoded into this message
+    instead of a new one.
+    """
+    magic, raw_header_size = _unpack_header_prefix(buf, offset)
+    if magic != 0xdeaddead:
+        raise Exception(f'Invalid magic in trace file (0x{magic:x})')
+    offset += _HEADER_PREFIX_SIZE
+
+    raw_header = buf[offset:offset + raw_header_size]
+    offset += raw_header_size
+
+    raw_item_size, = _unpack_integer(buf, offset)
+    offset += _INTEGER_SIZE
+
+    if offset + raw_item_size > len(buf):
+        raise Exception('Truncated trace entry')
+
+    item_offset = offset
+    offset += raw_item_size
+
+    if header is None:
+        header = TraceEntries_pb2.PbTraceItemHeader()
+    header.ParseFromString(raw_header)
+
+    # Pylint can't see some protobuf members
+    # pylint: disable=no-member
+    hdr_type = header.type
+
+    if forks_only and hdr_type != TraceEntries_pb2.TRACE_FORK:
+        return header, None, offset
+
+    item_class = _TRACE_ENTRY_TABLE[hdr_type] if hdr_type < len(_TRACE_ENTRY_TABLE) else None
+    if not item_class:
+        return header, None, offset
+
+    if lazy and hdr_type not in _EAGER_TYPES:
+        return header, LazyTraceEntry(item_class, buf[item_offset:offset]), offset
+
+    item = item_class()
+    item.ParseFromString(buf[item_offset:offset])
+
+    return header, item, offset
+
+
+def _map_trace_file(trace_file, sequential=False):
+    """
+    Map ``trace_file`` in memory and return it as a ``memoryview``. The
+    kernel pages the file in as it is accessed. Set ``sequential`` if the
+    file is going to be read from start to end.
+
+    The mapping stays valid after the file is closed and is unmapped once the
+    last view on it is released.
+    """
+    if not os.fstat(trace_file.fileno()).st_size:
+        # Empty files cannot be mapped
+        return memoryview(b'')
+
+    try:
+        buf = mmap.mmap(trace_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError as e:
+        # Some file systems do not support mmap. Fall back to reading the
+        # whole file, which still only takes a few large reads.
+        logger.debug('Could not map %s (%s), reading it instead', trace_file.name, e)
+        return memoryview(trace_file.read())
+
+    if sequential and hasattr(mmap, 'MADV_SEQUENTIAL'):
+        buf.madvise(mmap.MADV_SEQUENTIAL)
+
+    return memoryview(buf)
+
+
+def _read_trace_file(trace_file):
+    """
+    Get the contents of ``trace_file`` as a ``memoryview``.
+
+    Slicing a memoryview does not copy the underlying data, which saves two
+    allocations per entry.
+    """
+    # Read small and medium traces in one go. Larger ones are mapped instead,
+    # so that they do not have to fit in memory.
+    if os.fstat(trace_file.fileno()).st_size < _MAX_READ_SIZE:
+        return memoryview(trace_file.read())
+
+    return _map_trace_file(trace_file, sequential=True)
+
+
+def _scan_trace_buffer(buf):  # pylint: disable=too-many-locals
+    """
+    Locate the entries of every state in ``buf``, the contents of a single
+    trace file.
+
+    An S2E execution trace file (typically stored in ``ExecutionTracer.dat``)
+    is a binary file that contains data recorded by S2E's ``ExecutionTracer``
+    plugins. The trace file is essentially an array of ``(header, item)``
+    tuples. The header (of type ``TraceItemHeader``) describes the state and
+    type of the corresponding item. Only the headers and the fork items are
+    parsed here, the other items are parsed when they are accessed.
+
+    Returns a ``(states, unknown_types, error)`` tuple. ``states`` maps each
+    state ID found in ``buf`` to an ``(offsets, types, forks)`` tuple, where
+    ``offsets`` and ``types`` are arrays of the offsets and types of the
+    state's entries and ``forks`` maps the index of each fork entry in ``offsets`` to the IDs of
+    the new states that it forked. ``unknown_types`` counts the skipped entries of each
+    unknown type. ``error`` explains why the file could not be parsed to its
+    end, if it could not.
+    """
+    states = {}
+    unknown_types = collections.Counter()
+    current_element = -1
+    offset = 0
+    size = len(buf)
+
+    # This loop runs once per trace entry, so avoid repeated attribute
+    # lookups in its body
+    trace_fork = TraceEntries_pb2.TRACE_FORK
+    trace_entry_map = _TRACE_ENTRY_MAP
+
+    # Only a few fields of each header are needed, so decode all of them into
+    # the same message rather than allocating one per entry
+    scratch_header = TraceEntries_pb2.PbTraceItemHeader()
+
+    # Pylint can't see some protobuf members
+    # pylint: disable=no-member
+    while offset < size:
+        current_element += 1
+        entry_offset = offset
+
+        try:
+            header, item, offset = _read_trace_entry(buf, offset, forks_only=True, header=scratch_header)
+        except Exception as e:
+            return states, unknown_types, f'Could not parse entry {current_element} ({e})'
+
+        # Reading a header field goes through a protobuf descriptor, so read
+        # each field only once
+        entry_type = header.type
+
+        # If an unknown item type is found, just skip it
+        if entry_type not in trace_entry_map:
+            unknown_types[entry_type] += 1
+            continue
+
+        state_id = header.state_id
+        state = states.get(state_id)
+        if state is None:
+            state = states[state_id] = array.array('Q'), array.array('B'), {}
+
+        offsets, types, forks = state
+        if entry_type == trace_fork:
+            # A fork whose only child is the current state does not start any
+            # new state. It is parsed on access, like other entries.
+            children = dict.fromkeys(item.children)
+            children.pop(state_id, None)
+            if children:
+                forks[len(offsets)] = tuple(children)
+        offsets.append(entry_offset)
+        types.append(entry_type)
+
+    return states, unknown_types, None
+
+
+def _scan_trace_file(trace_file_path):
+    """
+    Run ``_scan_trace_buffer`` on the contents of the given trace file.
+    """
+    with open(trace_file_path, 'rb', buffering=0) as trace_file:
+        return _scan_trace_buffer(_read_trace_file(trace_file))
+
+
+class TraceView(collections.abc.Sequence):
+    """
+    The execution trace of a single state, i.e. a sequence of
+    ``(TraceItemHeader, TraceEntry)`` tuples.
+
+    Only the location of each entry in the trace files is stored, the entry is
+    parsed every time it is accessed. This keeps the memory usage of large
+    traces close to the size of the trace files. Forks are the exception: they
+    are stored as parsed, because their ``children`` are filled in when the
+    execution tree is reconstructed.
+
+    The type of each entry is also stored, in the ``types`` array. This lets
+    clients look for entries of a given type without parsing all of them.
+    """
+    __slots__ = ('_buffers', '_buffer_ids', '_offsets', '_forks', 'types')
+
+    def __init__(self, buffers):
+        self._buffers = buffers
+        self._buffer_ids = array.array('I')
+        self._offsets = array.array('Q')
+        self._forks = {}
+        self.types = array.array('B')
+
+    def add_entries(self, buffer_id, offsets, types, forks):
+        """
+        Append the entries located at ``offsets`` in the given buffer.
+        ``types`` are the types of these entries and ``forks`` maps the index
+        of each fork entry in ``offsets`` to the parsed entry.
+        """
+        start = len(self._offsets)
+        for index, entry in forks.items():
+            self._forks[start + index] = entry
+
+        self._buffer_ids.extend(array.array('I', [buffer_id]) * len(offsets))
+        self._offsets.extend(offsets)
+        self.types.extend(types)
+
+    def __deepcopy__(self, memo):
+        # The contents of the trace files are never modified, the copy shares
+        # them
+        view = TraceView(self._buffers)
+        memo[id(self)] = view
+
+        view._buffer_ids = self._buffer_ids[:]
+        view._offsets = self._offsets[:]
+        view._forks = copy.deepcopy(self._forks, memo)
+        view.types = self.types[:]
+        return view
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+            if index < 0:
+                raise IndexError('trace index out of range')
+
+        entry = self._forks.get(index)
+        if entry:
+            return entry
+
+        buf = self._buffers[self._buffer_ids[index]]
+        header, item, _ = _read_trace_entry(buf, self._offsets[index], lazy=True)
+
+        # Forks that did not create any new state are not stored
+        if self.types[index] == TraceEntries_pb2.TRACE_FORK:
+            item = TraceEntryFork({})
+
+        return header, item
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def iter_entries(self, types):
+        """
+        Iterate over the entries whose type is in ``types``. The other entries
+        are skipped without being parsed.
+        """
+        for index, entry_type in enumerate(self.types):
+            if entry_type in types:
+                yield self[index]
+
+
 class ExecutionTraceParser:
     """
     Parser for S2E execution trace files.
@@ -132,23 +498,27 @@ class ExecutionTraceParser:
     Finally, we terminate because S0 has no parent. The entire execution tree
     is now stored in the S0 execution trace list.
 
-    Now assume that the user is only interested in S1. During the initial file
-    parsing phase, we can assume that any state > 1 is forked after S1 is
-    forked and hence is of no interest. Therefore we do not need to store the
-    data associated with these states.
+    Now assume that the user is only interested in S1. The trace files are
+    then first scanned for fork entries only, which fills ``_path_info``
+    without storing any trace entry. This tells us that only S1 and its
+    parent S0 are needed, so the data associated with any other state is not
+    stored when the files are parsed.
 
-    During the construction of the final tree, we can further discard
-    information that is no longer required. For example, after S0 forks S1, we
-    are no longer interested in the remainder of S0 (i.e. elements ``[S0_3,
-    S0_4, ...]`` in ``_execution_traces[0]``). Likewise if the user is only
+    We can further discard information that is no longer required. For
+    example, after S0 forks S1, we are no longer interested in the remainder
+    of S0 (i.e. elements ``[S0_3, S0_4, ...]`` in ``_execution_traces[0]``),
+    so these entries are skipped as well. Likewise if the user is only
     interested in S2, then all of the trace entries that follow S2's fork point
-    (i.e. ``[S1_2, ...]``) and S1's fork point (i.e. ``[S0_3, S0_4, ...]``) can
-    be discarded.
+    (i.e. ``[S1_2, ...]``) and S1's fork point (i.e. ``[S0_3, S0_4, ...]``) are
+    never stored.
 
     Attributes:
         _trace_files: A list of ``ExecutionTracer.dat`` file paths.
+        _buffers: The contents of the trace files, from which the trace
+                  entries are parsed on access.
         _execution_traces: A dictionary of state IDs to the execution trace (a
-                           list of ``(TraceItemHeader, TraceEntry)`` tuples).
+                           ``TraceView`` of ``(TraceItemHeader, TraceEntry)``
+                           tuples).
         _path_info: A map of state IDs to a tuple containing:
                         1. The parent state's ID
                         2. A "fork point". This is an index into state ID's
@@ -159,12 +529,13 @@ class ExecutionTraceParser:
 
     def __init__(self, trace_files):
         self._trace_files = trace_files
-        self._execution_traces = {}
+        self._buffers = []
+        self._execution_traces = collections.defaultdict(functools.partial(TraceView, self._buffers))
         self._path_info = {}
 
         # Map of state IDs to the number of entries for that particular
         # state/path. Used for determining fork points.
-        self._path_lengths = {}
+        self._path_lengths = collections.defaultdict(int)
 
     def parse(self, path_ids=None):
         """
@@ -182,28 +553,30 @@ class ExecutionTraceParser:
                       execution tree. If no path IDs are given, the complete
                       execution tree is parsed.
         """
-        # Parse individual trace files
-        for trace_file_path in self._trace_files:
-            with open(trace_file_path, 'rb') as trace_file:
-                logger.debug('Parsing %s', trace_file_path)
-                self._parse_trace_file(trace_file, path_ids)
+        trace_file_states = self._scan_trace_files()
+
+        for states in trace_file_states:
+            self._update_path_info(states)
 
         # If a list of path IDs is given, we will return these states plus
-        # their parents.
+        # their parents. Now that the fork points of all states are known,
+        # entries that would be discarded later are not stored at all.
         #
         # If no path IDs are given, we will return all states.
         if path_ids:
-            states_to_return = set(path_ids)
-            for state_id in path_ids:
-                parent_states = self._get_parent_states(state_id)
-                states_to_return.update(parent_states)
+            entry_limits = self._get_entry_limits(path_ids)
 
             # Exclude the initial state, state 0, because that will always be
             # the root of the execution tree
+            states_to_return = set(entry_limits)
             states_to_return.discard(0)
         else:
+            entry_limits = None
             states_to_return = list(self._path_info.keys())
 
+        for buffer_id, states in enumerate(trace_file_states):
+            self._add_entries(buffer_id, states, entry_limits)
+
         # Reconstruct the execution tree for the given state IDs
         for state_id in sorted(states_to_return, reverse=True):
             parent_state_id, fork_point = self._path_info[state_id]
@@ -212,150 +585,186 @@ class ExecutionTraceParser:
 
             trace_fork.children[state_id] = self._execution_traces.get(state_id, [])
 
-            # If the parent's execution trace is not one we are interested in,
-            # stop following it once it forks to a path that we are interested
-            # in
-            if path_ids and parent_state_id not in path_ids:
-                del parent_execution_trace[fork_point + 1:]
-
         # We have an empty trace
         if 0 not in self._execution_traces:
             return []
 
         return self._execution_traces[0]
 
-    @staticmethod
-    def _read_trace_entry(trace_file):
-        magic, raw_header_size = _HEADER_PREFIX.unpack(trace_file.read(8))
-        if magic != 0xdeaddead:
-            raise Exception(f'Invalid magic in trace file (0x{magic:x})')
+    def _get_entry_limits(self, path_ids):
+        """
+        Get the number of trace entries to keep for each state needed to
+        return the given ``path_ids``.
+
+        The requested states are kept in full. For their parents, we are no
+        longer interested in the remainder of the trace once the last
+        interesting child has been forked, so only the entries up to and
+        including that fork are kept.
+        """
+        path_info = self._path_info
+        entry_limits = {}
 
-        raw_header = trace_file.read(raw_header_size)
-        raw_item_size = _INTEGER.unpack(trace_file.read(4))[0]
-        raw_item = trace_file.read(raw_item_size)
+        # States whose ancestors have already been updated
+        walked = set()
 
-        header = TraceEntries_pb2.PbTraceItemHeader()
-        header.ParseFromString(raw_header)
+        for state_id in path_ids:
+            if state_id and state_id not in path_info:
+                logger.warning('State %d does not appear in the execution trace', state_id)
+                continue
 
-        # Pylint can't see some protobuf members
-        # pylint: disable=no-member
-        hdr_type = header.type
+            entry_limits[state_id] = sys.maxsize
 
-        if hdr_type not in _TRACE_ENTRY_MAP:
-            # If an unknown item type is found, just skip it
-            logger.warning('Found unknown trace item `%s`', hdr_type)
-            return None
+            # Walk up to the initial state. Once we reach a state that was
+            # already walked, the rest of the path is shared with a previous
+            # state and its limits are already up to date.
+            while state_id not in walked:
+                walked.add(state_id)
+                parent_info = path_info.get(state_id)
+                if parent_info is None:
+                    break
 
-        item = _TRACE_ENTRY_MAP[hdr_type]()
-        item.ParseFromString(raw_item)
+                parent_state_id, fork_point = parent_info
+                entry_limits[parent_state_id] = max(entry_limits.get(parent_state_id, 0), fork_point + 1)
+                state_id = parent_state_id
 
-        return header, item
+        return entry_limits
 
-    def _parse_trace_file(self, trace_file, path_ids=None):
+    def _scan_trace_files(self):
         """
-        Parse a single ``trace_file``.
-
-        This method will iterate over all of the entries in the given trace
-        file. An S2E execution trace file (typically stored in
-        ``ExecutionTracer.dat``) is a binary file that contains data recorded
-        by S2E's ``ExecutionTracer`` plugins. The trace file is essentially an
-        array of ``(header, item)`` tuples. The header (of type
-        ``TraceItemHeader``) describes the size and type of the corresponding
-        item. Base on this information we can then parse the item and
-        instantiate the correct ``TraceEntry`` class.
-
-        The following information is recorded and stored in the class's
-        attributes:
-            * The execution trace data (a list of ``(TraceItemHeader,
-              TraceEntry)`` tuples) for the states found in the ``trace_file``.
-            * For each state ID found in the ``trace_file``, record its parent
-              state ID. This is so that we can reconstruct the execution tree
-              once all of the trace files have been individually parsed.
-            * If a state forks, record the "fork point". This is just an index
-              into the execution trace list and is also used for reconstructing
-              the final execution tree.
-
-        If ``path_ids`` is specified, only states with an ID less than the
-        maximum path ID will be saved.
+        Locate the entries of every state in the trace files.
+
+        Returns one ``_scan_trace_buffer`` result per trace file. The trace
+        files are independent from each other, so they are scanned in
+        parallel when there are several of them. The contents of each trace
+        file are kept in ``_buffers``, in the same order.
+
+        The worker processes cannot share their buffers with this process, so
+        the files scanned in parallel are mapped here instead of being read a
+        second time. Their pages are then only loaded, usually from the page
+        cache, when the corresponding entries are accessed.
         """
-        # The maximum state ID to return an execution trace for
-        max_path_id = max(path_ids) if path_ids else None
-        current_element = -1
-
-        while True:
-            current_element += 1
-
-            try:
-                header, item = self._read_trace_entry(trace_file)
-            except EOFError:
-                break
-            except Exception as e:
+        if len(self._trace_files) > 1:
+            max_workers = min(len(self._trace_files), os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(_scan_trace_file, self._trace_files))
+
+            for trace_file_path in self._trace_files:
+                with open(trace_file_path, 'rb', buffering=0) as trace_file:
+                    self._buffers.append(_map_trace_file(trace_file))
+        else:
+            results = []
+            for trace_file_path in self._trace_files:
+                with open(trace_file_path, 'rb', buffering=0) as trace_file:
+                    buf = _read_trace_file(trace_file)
+                results.append(_scan_trace_buffer(buf))
+                self._buffers.append(buf)
+
+        trace_file_states = []
+        for trace_file_path, (states, unknown_types, error) in zip(self._trace_files, results):
+            # Report each unknown type once, rather than once per entry
+            for item_type, count in unknown_types.items():
+                logger.warning('Found %d unknown trace items of type `%s` in file %s',
+                               count, item_type, trace_file_path)
+
+            if error:
                 # This usually means that the trace was truncated (e.g., S2E was killed)
-                logger.warning('Could not parse entry %d in file %s (%s)', current_element, trace_file.name, e)
-                break
+                logger.warning('%s in file %s', error, trace_file_path)
+            trace_file_states.append(states)
 
-            if not item:
-                # Unknown item, skip it
-                continue
+        return trace_file_states
 
-            # Skip any states that have an ID greater than that which we have
-            # been asked to parse
-            current_state_id = header.state_id
-            if path_ids and current_state_id > max_path_id:
-                continue
+    def _update_path_info(self, states):
+        """
+        Record the parent and fork point of every state forked in a trace
+        file. ``states`` is the result of scanning this file.
 
-            # If the item is a state fork, we must update the ``_path_info``
-            # dictionary with the parent and fork point information
-            if header.type == TraceEntries_pb2.TRACE_FORK:
-                new_children = {}
-
-                for child_state_id in item.children:
-                    # For each child state, save:
-                    #   * The state ID of the parent
-                    #   * The index into the current state's execution trace
-                    #     indicating where the fork occurred
-                    #   * Create a entry for the new state in the main trace
-                    #     dictionary
-                    if child_state_id != current_state_id:
-                        fork_point = self._path_lengths.get(current_state_id, 0)
-                        self._path_info[child_state_id] = current_state_id, fork_point
-
-                        # When parsed directly from the trace file, the
-                        # ``children`` attribute in a ``TraceFork`` object is a
-                        # list of state IDs. To correctly represent the
-                        # execution trace, we transform this list into a
-                        # dictionary mapping state IDs to a new execution trace
-                        # (i.e. a list of ``(TraceItemHeader, TraceEntry)``
-                        # tuples). This list is initially empty.
-                        new_children[child_state_id] = []
+        A state may continue in the next trace file, so its fork points are
+        offset by the number of entries that it has in the previous files.
+        """
+        path_info = self._path_info
+        path_lengths = self._path_lengths
 
-                # Since a ``TraceEntry`` is immutable, we have to create a new
-                # one if we want to use the ``new_children`` dictionary
-                item = TraceEntryFork(new_children)
+        for state_id, (offsets, _, forks) in states.items():
+            path_length = path_lengths[state_id]
 
-            # Append the ``(TraceItemHeader, TraceEntry)`` tuple to the
-            # execution trace for this state
-            if current_state_id not in self._execution_traces:
-                self._execution_traces[current_state_id] = []
-            self._execution_traces[current_state_id].append((header, item))
+            for index, children in forks.items():
+                # For each child state, save:
+                #   * The state ID of the parent
+                #   * The index into the current state's execution trace
+                #     indicating where the fork occurred
+                path_info.update(dict.fromkeys(children, (state_id, path_length + index)))
 
-            # Update the path length information for future fork points
-            if current_state_id not in self._path_lengths:
-                self._path_lengths[current_state_id] = 0
-            self._path_lengths[current_state_id] += 1
+            path_lengths[state_id] = path_length + len(offsets)
 
-    def _get_parent_states(self, state_id):
+    def _add_entries(self, buffer_id, states, entry_limits=None):
         """
-        Get the list of parent state IDs for the given ``state_id``.
+        Append the entries of a trace file to the execution trace of their
+        state. ``states`` is the result of scanning this file.
+
+        If ``entry_limits`` is given, only the states that it contains are
+        stored, up to their maximum number of entries.
         """
-        current_state_id = state_id
-        parent_states = []
+        buf = self._buffers[buffer_id]
+        execution_traces = self._execution_traces
+
+        for state_id, (offsets, types, forks) in states.items():
+            if entry_limits is not None:
+                count = entry_limits.get(state_id, 0) - len(execution_traces.get(state_id, ()))
+                if count <= 0:
+                    continue
+                if count < len(offsets):
+                    offsets = offsets[:count]
+                    types = types[:count]
+
+            new_forks = {}
+            for index, children in forks.items():
+                if index >= len(offsets):
+                    break
+
+                # Only the children of forks cross process boundaries, so
+                # parse the header again
+                header, _, _ = _read_trace_entry(buf, offsets[index], forks_only=True)
+
+                # When parsed directly from the trace file, the ``children``
+                # attribute in a ``TraceFork`` object is a list of state IDs.
+                # To correctly represent the execution trace, we transform
+                # this list into a dictionary mapping state IDs to a new
+                # execution trace (i.e. a list of ``(TraceItemHeader,
+                # TraceEntry)`` tuples). This list is initially empty.
+                #
+                # Since a ``TraceEntry`` is immutable, we have to create a new
+                # one if we want to use this dictionary
+                new_forks[index] = header, TraceEntryFork({child_state_id: [] for child_state_id in children})
+
+            execution_traces[state_id].add_entries(buffer_id, offsets, types, new_forks)
 
-        while current_state_id:
-            current_state_id, _ = self._path_info.get(current_state_id)
-            parent_states.append(current_state_id)
 
-        return parent_states
+def _get_trace_files(results_dir):
+    """
+    Return the paths of the ``ExecutionTracer.dat`` files in ``results_dir``.
+
+    Single-node runs write the trace file directly in ``results_dir``, while
+    multi-node runs write one in the directory of each S2E process, named
+    after its id. The latter are sorted by increasing id, so that it is
+    possible to concatenate them.
+    """
+    trace_files = []
+    node_trace_files = []
+
+    try:
+        with os.scandir(results_dir) as entries:
+            for entry in entries:
+                if entry.name == 'ExecutionTracer.dat':
+                    trace_files.append(entry.path)
+                elif entry.name.isdigit() and entry.is_dir():
+                    trace_file = os.path.join(entry.path, 'ExecutionTracer.dat')
+                    if os.path.isfile(trace_file):
+                        node_trace_files.append((int(entry.name), trace_file))
+    except FileNotFoundError:
+        return []
+
+    node_trace_files.sort()
+    return trace_files + [trace_file for _, trace_file in node_trace_files]
 
 
 def parse(results_dir, path_ids=None):
@@ -376,26 +785,20 @@ def parse(results_dir, path_ids=None):
     """
     # Get the ExecutionTracer.dat file(s). Include both multi-node and single
     # node results
-    execution_trace_files = glob.glob(os.path.join(results_dir, '*', 'ExecutionTracer.dat')) + \
-                            glob.glob(os.path.join(results_dir, 'ExecutionTracer.dat'))
+    execution_trace_files = _get_trace_files(results_dir)
 
     if not execution_trace_files:
         logger.warning('No \'ExecutionTrace.dat\' file found in s2e-last. Did '
                        'you enable any trace plugins in s2e-config.lua?')
         return []
 
-    if len(execution_trace_files) > 1:
-        # We must sort the traces by increasing id, so that it is possible to concatenate them
-        ids = []
-        for f in execution_trace_files:
-            dirname = os.path.dirname(f)
-            trace_id = os.path.basename(dirname)
-            ids.append(int(trace_id))
-
-        execution_trace_files = []
-        for trace_id in sorted(ids):
-            trace_file = os.path.join(results_dir, str(trace_id), 'ExecutionTracer.dat')
-            execution_trace_files.append(trace_file)
+    # Protobuf picks its native implementation by itself when it is
+    # available. TraceEntries_pb2 was generated for protobuf 3, so the upb
+    # backend of protobuf 4 cannot be used instead.
+    global _protobuf_implementation_logged
+    if not _protobuf_implementation_logged and api_implementation.Type() == 'python':
+        logger.info('Protobuf uses its pure-Python implementation, parsing large traces may take a while')
+        _protobuf_implementation_logged = True
 
     # Parse the execution trace file(s) to construct a single execution tree.
     execution_trace_parser = ExecutionTraceParser(execution_trace_files)
@@ -23,7 +23,7 @@ SOFTWARE.
 
 import logging
 
-from s2e_env.execution_trace import TraceEntries_pb2
+from s2e_env.execution_trace import TraceEntries_pb2, TraceView
 
 from .modules import Module, ModuleMap
 
@@ -31,6 +31,8 @@ logger = logging.getLogger('analyzer')
 
 
 class AnalyzerState:
+    __slots__ = ('_modules',)
+
     def __init__(self, modules=None):
         if not modules:
             modules = ModuleMap()
@@ -55,40 +57,75 @@ class Analyzer:
     counter belongs at any point of the execution tree.
     """
 
-    def __init__(self, execution_tree, cb):
+    def __init__(self, execution_tree, cb, types_of_interest=None):
         """
         Sets up an instance of the analyzer using the given trace and callback.
 
         :param execution_tree: tree obtained with the parse_execution_tree function
         :param cb: callback to be invoked on every trace item. First argument is an instance of AnalyzerState,
         the second is the trace item header, the third is the item itself.
+        :param types_of_interest: if given, the callback is only invoked on trace items of these types. Items that
+        neither the callback nor the analyzer need are not decoded at all.
         """
         self._tree = execution_tree
         self._cb = cb
+        self._types_of_interest = frozenset(types_of_interest) if types_of_interest is not None else None
 
     def walk_tree(self):
         stack = []
 
         stack.append((self._tree, AnalyzerState()))
 
+        # Avoid attribute lookups in the loop, which runs for every trace item
+        handlers = _HANDLERS
+        cb = self._cb
+        types = self._types_of_interest
+        decoded_types = None
+        if types is not None:
+            decoded_types = types | handlers.keys()
+
         while stack:
             trace, state = stack.pop()
 
-            for header, item in trace:
-                if header.type == TraceEntries_pb2.TRACE_FORK:
-                    for child_trace in item.children.values():
-                        ns = state.clone()
-                        stack.append((child_trace, ns))
-                elif header.type == TraceEntries_pb2.TRACE_OSINFO:
-                    state.modules.kernel_start = item.kernel_start
-                elif header.type == TraceEntries_pb2.TRACE_MOD_LOAD:
-                    mod = Module(item)
-                    state.modules.add(mod)
-                elif header.type == TraceEntries_pb2.TRACE_MOD_UNLOAD:
-                    mod = Module(item)
-                    try:
-                        state.modules.remove(mod)
-                    except Exception:
-                        pass
-
-                self._cb(state, header, item)
+            entries = trace
+            if decoded_types is not None and isinstance(trace, TraceView):
+                entries = trace.iter_entries(decoded_types)
+
+            for header, item in entries:
+                entry_type = header.type
+                handler = handlers.get(entry_type)
+                if handler:
+                    handler(stack, state, item)
+
+                if types is None or entry_type in types:
+                    cb(state, header, item)
+
+
+def _handle_fork(stack, state, item):
+    for child_trace in item.children.values():
+        ns = state.clone()
+        stack.append((child_trace, ns))
+
+
+def _handle_os_info(_, state, item):
+    state.modules.kernel_start = item.kernel_start
+
+
+def _handle_module_load(_, state, item):
+    mod = Module(item)
+    state.modules.add(mod)
+
+
+def _handle_module_unload(_, state, item):
+    mod = Module(item)
+    state.modules.remove(mod)
+
+
+# Maps the trace item types that affect the analyzer state to the function
+# that updates it
+_HANDLERS = {
+    TraceEntries_pb2.TRACE_FORK: _handle_fork,
+    TraceEntries_pb2.TRACE_OSINFO: _handle_os_info,
+    TraceEntries_pb2.TRACE_MOD_LOAD: _handle_module_load,
+    TraceEntries_pb2.TRACE_MOD_UNLOAD: _handle_module_unload,
+}
@@ -23,6 +23,7 @@ SOFTWARE.
 import bisect
 import logging
 
+from array import array
 from functools import total_ordering
 
 import immutables
@@ -30,7 +31,6 @@ import immutables
 logger = logging.getLogger('analyzer')
 
 
-@total_ordering
 class SectionDescriptor:
     __slots__ = (
         'name', 'runtime_load_base', 'native_load_base', 'size',
@@ -54,7 +54,7 @@ class SectionDescriptor:
         return hash((self.runtime_load_base, self.size))
 
     def __eq__(self, other):
-        return not self < other and not other < self
+        return self.runtime_load_base == other.runtime_load_base and self.size == other.size
 
     def __lt__(self, other):
         return self.runtime_load_base + self.size <= other.runtime_load_base
@@ -83,8 +83,11 @@ class Module:
             self.pid = 0
 
     def get_section(self, pc):
+        # Same as calling contains() on each section, without the overhead of
+        # a method call per section
         for section in self.sections:
-            if section.contains(pc):
+            base = section.runtime_load_base
+            if base <= pc < base + section.size:
                 return section
         return None
 
@@ -108,86 +111,159 @@ class Module:
         return f'Module name:{self.name} ({self.path}) pid:{self.pid}'
 
 
-def _index(sections, x):
-    i = bisect.bisect_left(sections, x)
-    if i != len(sections) and sections[i] == x:
-        return i
+def _index(sections, bases, x):
+    """
+    Return ``(i, found)``, where ``i`` is the position of the first section
+    that does not end before ``x`` and ``found`` tells whether that section
+    overlaps ``x``.
+
+    ``bases`` holds the runtime load bases of the (non-overlapping, sorted)
+    ``sections``. Bisecting it compares plain integers instead of calling
+    ``SectionDescriptor.__lt__`` for every probe.
+    """
+    base = x.runtime_load_base
+    i = bisect.bisect_right(bases, base)
+    if i and sections[i - 1].runtime_load_base + sections[i - 1].size > base:
+        i -= 1
+
+    return i, i != len(bases) and bases[i] < base + x.size
+
+
+# Value of ``ModuleMap._last_lookup`` when no lookup is cached
+_NO_LOOKUP = (None, 0, 0, None)
 
-    return None
+# Sections of a pid that has none loaded
+_NO_SECTIONS = ([], (), [])
 
 
 class ModuleMap:
+    __slots__ = ('_pid_to_sections', '_kernel_start', '_last_lookup')
+
     def __init__(self):
         # Use immutable structures for copy-on-write. It is much faster than
         # doing deepcopy of normal maps, especially when there are many states.
+        #
+        # Each pid maps to a (sections, bases, modules) tuple. ``sections``
+        # is sorted by address, ``bases`` holds their runtime load bases and
+        # ``modules`` the module that each of them belongs to. Looking up an
+        # address among plain integers is much faster than comparing section
+        # descriptors, and keeping the three together makes it a single map
+        # lookup, whether the address belongs to the kernel or to a process.
         self._pid_to_sections = immutables.Map()
-        self._section_to_module = immutables.Map()
         self._kernel_start = 0xffffffffffffffff
 
+        # Consecutive lookups usually hit the same section, so remember the
+        # last one as a (pid, section start, section end, module) tuple.
+        # Adding sections cannot change the result, as they may not overlap
+        # the existing ones, so only removals invalidate it.
+        self._last_lookup = _NO_LOOKUP
+
     def add(self, mod):
-        pid_sections = self._pid_to_sections.get(mod.pid, []).copy()
+        pid_sections, pid_bases, pid_modules = self._pid_to_sections.get(mod.pid, _NO_SECTIONS)
+        pid_sections = pid_sections.copy()
+        pid_bases = array('Q', pid_bases)
+        pid_modules = pid_modules.copy()
 
         for section in mod.sections:
             if not section.size:
                 raise Exception(f'Section {section} of module {mod} has zero size')
 
-            idx = _index(pid_sections, section)
-            if idx is not None:
-                logger.warning('Section already loaded: %s - module %s',
-                               section, self._section_to_module[(mod.pid, pid_sections[idx])])
+            idx, found = _index(pid_sections, pid_bases, section)
+            if found:
+                logger.warning('Section already loaded: %s - module %s', section, pid_modules[idx])
                 continue
 
-            bisect.insort(pid_sections, section)
-            self._section_to_module = self._section_to_module.set((mod.pid, section), mod)
+            pid_sections.insert(idx, section)
+            pid_bases.insert(idx, section.runtime_load_base)
+            pid_modules.insert(idx, mod)
 
-        self._pid_to_sections = self._pid_to_sections.set(mod.pid, pid_sections)
+        self._pid_to_sections = self._pid_to_sections.set(mod.pid, (pid_sections, pid_bases, pid_modules))
 
     def remove(self, mod):
-        pid_sections = self._pid_to_sections[mod.pid].copy()
+        """
+        Remove the sections of the given module. Sections that are not loaded
+        are ignored.
+
+        Returns ``True`` if at least one section was removed.
+        """
+        pid_sections, pid_bases, pid_modules = self._pid_to_sections.get(mod.pid, _NO_SECTIONS)
+        if not pid_sections:
+            return False
+
+        pid_sections = pid_sections.copy()
+        pid_bases = array('Q', pid_bases)
+        pid_modules = pid_modules.copy()
+        removed = False
+
         for section in mod.sections:
-            idx = _index(pid_sections, section)
-            if idx is not None:
-                del pid_sections[idx]
-                self._section_to_module = self._section_to_module.delete((mod.pid, section))
-                self._pid_to_sections = self._pid_to_sections.set(mod.pid, pid_sections)
+            idx, found = _index(pid_sections, pid_bases, section)
+
+            # The section must match a loaded one exactly, not just overlap it
+            if not found or pid_sections[idx] != section:
+                continue
+
+            del pid_sections[idx]
+            del pid_bases[idx]
+            del pid_modules[idx]
+            removed = True
+
+        if removed:
+            self._pid_to_sections = self._pid_to_sections.set(mod.pid, (pid_sections, pid_bases, pid_modules))
+            self._last_lookup = _NO_LOOKUP
+
+        return removed
 
     def remove_pid(self, pid):
         self._pid_to_sections = self._pid_to_sections.delete(pid)
-        for k, _ in self._section_to_module.items():
-            if k[0] == pid:
-                self._section_to_module = self._section_to_module.delete(k)
+        self._last_lookup = _NO_LOOKUP
 
     def get(self, pid, pc):
         pid = self._translate_pid(pid, pc)
-        if pid not in self._pid_to_sections:
-            raise Exception(f'Could not find pid={pid}')
 
-        sections = self._pid_to_sections[pid]
-        sd = SectionDescriptor(None)
-        sd.runtime_load_base = pc
-        sd.size = 1
+        last_pid, last_start, last_end, last_module = self._last_lookup
+        if pid == last_pid and last_start <= pc < last_end:
+            return last_module
 
-        idx = _index(sections, sd)
-        if idx is None:
-            raise Exception(f'Could not find section containing address 0x{pc:x}')
+        pid_sections = self._pid_to_sections.get(pid)
+        if pid_sections is None:
+            raise Exception(f'Could not find pid={pid}')
 
-        section = sections[idx]
-        return self._section_to_module[(pid, section)]
+        # Sections do not overlap, so the only candidate is the last one that
+        # starts at or before pc
+        sections, bases, modules = pid_sections
+        idx = bisect.bisect_right(bases, pc) - 1
+        if idx >= 0:
+            # The bisection already ensures that the section starts at or
+            # before pc, only its end remains to be checked
+            start = bases[idx]
+            end = start + sections[idx].size
+            if pc < end:
+                module = modules[idx]
+                self._last_lookup = pid, start, end, module
+                return module
+
+        raise Exception(f'Could not find section containing address 0x{pc:x}')
 
     def dump(self):
+        # Do not walk the whole map for nothing
+        if not logger.isEnabledFor(logging.INFO):
+            return
+
         logger.info('Dumping module map')
-        for pid, sections in list(self._pid_to_sections.items()):
-            for section in sections:
-                s = module = None
-                logger.info('pid=%d section=(%s) module=(%s) section=(%s)', pid, section, module, s)
+        for pid, (sections, _, modules) in self._pid_to_sections.items():
+            for section, module in zip(sections, modules):
+                logger.info('pid=%d section=(%s) module=(%s)', pid, section, module)
         logger.info('Dumping module map done')
 
     def clone(self):
+        # The maps are immutable, so the clone can share them: it is a
+        # constant time operation. Bypass __init__, which would allocate maps
+        # that are replaced right away.
         # pylint: disable=protected-access
-        ret = ModuleMap()
+        ret = ModuleMap.__new__(ModuleMap)
         ret._pid_to_sections = self._pid_to_sections
-        ret._section_to_module = self._section_to_module
         ret._kernel_start = self._kernel_start
+        ret._last_lookup = self._last_lookup
         return ret
 
     def _translate_pid(self, pid, pc):
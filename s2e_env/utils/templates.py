@@ -62,6 +62,19 @@ def _init_template_env(templates_dir=None):
     return env
 
 
+@memoize
+def _get_compiled_template(templates_dir, template):
+    """
+    Load and compile the ``template`` template from the given directory.
+
+    The compiled template is cached so that rendering the same template many
+    times (e.g., once per image when generating the testsuite) only parses the
+    Jinja source once.
+    """
+    env = _init_template_env(templates_dir)
+    return env.get_template(template)
+
+
 def render_template(context, template, output_path=None, templates_dir=None,
                     executable=False):
     """
@@ -70,9 +83,7 @@ def render_template(context, template, output_path=None, templates_dir=None,
 
     A directory containing the Jinja templates can optionally be specified.
     """
-    env = _init_template_env(templates_dir)
-
-    rendered_data = env.get_template(template).render(context)
+    rendered_data = _get_compiled_template(templates_dir, template).render(context)
 
     # Remove trailing spaces
     cleaned_lines = []
@@ -0,0 +1,161 @@
+"""
+Copyright (c) 2017 Dependable Systems Laboratory, EPFL
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from jinja2.exceptions import UndefinedError
+
+from s2e_env.commands.testsuite import _get_max_instances, _get_simple_template, _release_memory, \
+                                       _render_run_tests, _reserve_memory
+from s2e_env.utils.templates import render_template
+
+
+GB = 1024 * 1024 * 1024
+
+
+def _make_state(budget):
+    return {
+        'terminating': False,
+        'mem_budget': budget,
+        'mem_cond': threading.Condition(),
+        'reserved_mem': 0,
+    }
+
+
+class MaxInstancesTestCase(TestCase):
+    def test_mixed_memory_limits(self):
+        # The smallest tests are packed first: 1 + 1 + 2 GB fit in 4 GB
+        instances = _get_max_instances([3 * GB, 1 * GB, 1 * GB, 2 * GB], (8, 4 * GB), log=False)
+        self.assertEqual(instances, 3)
+
+    def test_cpu_bound(self):
+        instances = _get_max_instances([1 * GB] * 8, (2, 64 * GB), log=False)
+        self.assertEqual(instances, 2)
+
+    def test_nothing_fits(self):
+        # At least one test must run, even if it does not fit
+        instances = _get_max_instances([8 * GB, 16 * GB], (4, 4 * GB), log=False)
+        self.assertEqual(instances, 1)
+
+    def test_explicit_instance_count(self):
+        instances = _get_max_instances([1 * GB], (4, 4 * GB), instances=7)
+        self.assertEqual(instances, 7)
+
+
+class MemoryReservationTestCase(TestCase):
+    def test_no_budget(self):
+        state = _make_state(None)
+        self.assertTrue(_reserve_memory(state, 100 * GB))
+        self.assertEqual(state['reserved_mem'], 0)
+
+    def test_first_instance_always_starts(self):
+        state = _make_state(2 * GB)
+        self.assertTrue(_reserve_memory(state, 3 * GB))
+        self.assertEqual(state['reserved_mem'], 3 * GB)
+
+    def test_mixed_reservations(self):
+        state = _make_state(4 * GB)
+        self.assertTrue(_reserve_memory(state, 3 * GB))
+        self.assertTrue(_reserve_memory(state, 1 * GB))
+
+        # There is no room left for a 2 GB instance: wait until it is
+        # cancelled
+        state['terminating'] = True
+        self.assertFalse(_reserve_memory(state, 2 * GB))
+        state['terminating'] = False
+
+        _release_memory(state, 3 * GB)
+        self.assertTrue(_reserve_memory(state, 2 * GB))
+        self.assertEqual(state['reserved_mem'], 3 * GB)
+
+    def test_release_wakes_up_waiters(self):
+        state = _make_state(4 * GB)
+        self.assertTrue(_reserve_memory(state, 3 * GB))
+
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(_reserve_memory(state, 2 * GB)))
+        waiter.start()
+
+        _release_memory(state, 3 * GB)
+        waiter.join(timeout=10)
+
+        self.assertEqual(result, [True])
+        self.assertEqual(state['reserved_mem'], 2 * GB)
+
+
+class RunTestsTemplateTestCase(TestCase):
+    def setUp(self):
+        self._ts_dir = tempfile.mkdtemp()
+        self._ctx = {
+            'test_dir': '/tmp/test',
+            'project_name': 'project',
+            'creation_time': '{{ test_dir }}',
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self._ts_dir)
+
+    def _write_template(self, name, source):
+        with open(os.path.join(self._ts_dir, name), 'w', encoding='utf-8', newline='') as fp:
+            fp.write(source)
+
+    def _check_same_as_jinja(self, source, simple=True):
+        # Templates are cached by path, use a new one for each source
+        name = f'run-tests-{len(os.listdir(self._ts_dir))}.tpl'
+        self._write_template(name, source)
+
+        self.assertEqual(_get_simple_template(os.path.join(self._ts_dir, name)) is not None, simple)
+        self.assertEqual(_render_run_tests(self._ts_dir, name, self._ctx),
+                         render_template(self._ctx, name, templates_dir=self._ts_dir))
+
+    def test_variables(self):
+        self._check_same_as_jinja('#!/bin/sh\ncd {{ test_dir }} && echo {{project_name}}  \n')
+
+    def test_no_recursive_substitution(self):
+        self._check_same_as_jinja('# {{ creation_time }}\n')
+
+    def test_trailing_newlines(self):
+        self._check_same_as_jinja('echo {{ project_name }}\n\n\n')
+        self._check_same_as_jinja('echo {{ project_name }}')
+
+    def test_line_endings(self):
+        self._check_same_as_jinja('echo {{ project_name }} \r\necho\r\n\r\n')
+        self._check_same_as_jinja('echo {{ project_name }}\rdone\r\r')
+
+    def test_bash_syntax(self):
+        self._check_same_as_jinja('echo ${#ARGS[@]} {# {{ test_dir }} #}\n')
+
+    def test_jinja_templates(self):
+        self._check_same_as_jinja('echo {{ project_name | upper }}\n', simple=False)
+        self._check_same_as_jinja('{% if project_name %}echo {{ project_name }}{% endif %}\n', simple=False)
+        self._check_same_as_jinja('{## comment ##}echo {{ project_name }}\n', simple=False)
+
+    def test_undefined_variable(self):
+        self._write_template('run-tests.tpl', 'echo {{ missing }}\n')
+
+        with self.assertRaises(UndefinedError):
+            _render_run_tests(self._ts_dir, 'run-tests.tpl', self._ctx)
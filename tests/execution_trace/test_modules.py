@@ -53,7 +53,8 @@ class ModulesTestCase(TestCase):
 
         map.remove(mod1)
         self.assertRaises(Exception, map.get, 123, 0x123000 + 1234)
-        self.assertEqual(len(map._section_to_module), 0)
+        _, _, modules = map._pid_to_sections[123]
+        self.assertEqual(modules, [])
 
         actual_mod = map1.get(123, 0x123000 + 1234)
         self.assertEqual(actual_mod, mod1)
@@ -69,7 +70,15 @@ class ModulesTestCase(TestCase):
         map.remove_pid(123)
 
         self.assertRaises(Exception, map.get, 123, 0x123000 + 1234)
-        self.assertEqual(len(map._section_to_module), 0)
+        self.assertNotIn(123, map._pid_to_sections)
 
         actual_mod = map1.get(123, 0x123000 + 1234)
         self.assertEqual(actual_mod, mod1)
+
+    def test_remove_unknown_module(self):
+        map = ModuleMap()
+        self.assertFalse(map.remove(mod1))
+
+        map.add(mod1)
+        self.assertTrue(map.remove(mod1))
+        self.assertFalse(map.remove(mod1))
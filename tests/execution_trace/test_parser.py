@@ -0,0 +1,189 @@
+"""
+Copyright (c) 2017 Dependable Systems Laboratory, EPFL
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import copy
+import os
+import shutil
+import struct
+import tempfile
+from unittest import TestCase
+
+from s2e_env.execution_trace import LazyTraceEntry, TraceEntries_pb2, parse
+from s2e_env.execution_trace.analyzer import Analyzer
+
+
+def _make_entry(state_id, entry_type, item):
+    header = TraceEntries_pb2.PbTraceItemHeader(state_id=state_id, timestamp=0, address_space=0,
+                                                pid=0, tid=0, pc=0, type=entry_type)
+    raw_header = header.SerializeToString()
+    raw_item = item.SerializeToString()
+    return struct.pack('<II', 0xdeaddead, len(raw_header)) + raw_header + \
+        struct.pack('<I', len(raw_item)) + raw_item
+
+
+def _fork(state_id, *children):
+    return _make_entry(state_id, TraceEntries_pb2.TRACE_FORK,
+                       TraceEntries_pb2.PbTraceItemFork(children=[state_id] + list(children)))
+
+
+def _os_info(state_id, kernel_start):
+    return _make_entry(state_id, TraceEntries_pb2.TRACE_OSINFO,
+                       TraceEntries_pb2.PbTraceOsInfo(kernel_start=kernel_start))
+
+
+def _summarize(trace):
+    """
+    Turn an execution tree into nested lists of kernel_start values and
+    {state_id: subtree} dictionaries.
+    """
+    summary = []
+    for header, item in trace:
+        if header.type == TraceEntries_pb2.TRACE_FORK:
+            summary.append({k: _summarize(v) for k, v in item.children.items()})
+        else:
+            summary.append(item.kernel_start)
+    return summary
+
+
+class ExecutionTraceParserTestCase(TestCase):
+    def setUp(self):
+        # S0 forks S1, then S2. S1 forks S3.
+        entries = [
+            _os_info(0, 1),
+            _fork(0, 1),
+            _os_info(1, 2),
+            _os_info(0, 3),
+            _fork(1, 3),
+            _fork(0, 2),
+            _os_info(2, 4),
+            _os_info(3, 5),
+            _os_info(0, 6),
+            _os_info(1, 7),
+        ]
+
+        self._results_dir = tempfile.mkdtemp()
+        with open(os.path.join(self._results_dir, 'ExecutionTracer.dat'), 'wb') as fp:
+            fp.write(b''.join(entries))
+
+    def tearDown(self):
+        shutil.rmtree(self._results_dir)
+
+    def test_parse_all(self):
+        trace = _summarize(parse(self._results_dir))
+        self.assertEqual(trace, [1, {1: [2, {3: [5]}, 7]}, 3, {2: [4]}, 6])
+
+    def test_parse_one_path(self):
+        trace = _summarize(parse(self._results_dir, [3]))
+        self.assertEqual(trace, [1, {1: [2, {3: [5]}]}])
+
+    def test_parse_sibling_paths(self):
+        # Both children of the uninteresting S0 must be kept
+        trace = _summarize(parse(self._results_dir, [1, 2]))
+        self.assertEqual(trace, [1, {1: [2, {3: []}, 7]}, 3, {2: [4]}])
+
+    def test_parse_unknown_path(self):
+        trace = _summarize(parse(self._results_dir, [2, 42]))
+        self.assertEqual(trace, [1, {1: []}, 3, {2: [4]}])
+
+    def test_trace_view(self):
+        trace = parse(self._results_dir)
+        self.assertEqual(len(trace), 5)
+        self.assertEqual(trace[-1][1].kernel_start, 6)
+        self.assertEqual(_summarize(trace[2:]), [3, {2: [4]}, 6])
+
+        for index in (-6, 5):
+            with self.assertRaises(IndexError):
+                trace[index]  # pylint: disable=pointless-statement
+
+        fork, os_info = TraceEntries_pb2.TRACE_FORK, TraceEntries_pb2.TRACE_OSINFO
+        self.assertEqual(list(trace.types), [os_info, fork, os_info, fork, os_info])
+
+        trace_copy = copy.deepcopy(trace)
+        self.assertEqual(_summarize(trace_copy), _summarize(trace))
+        trace_copy[1][1].children.clear()
+        self.assertEqual(_summarize(trace), [1, {1: [2, {3: [5]}, 7]}, 3, {2: [4]}, 6])
+
+    def test_analyzer_types_of_interest(self):
+        seen = []
+
+        def cb(state, header, _):
+            seen.append((header.state_id, state.modules.kernel_start))
+
+        Analyzer(parse(self._results_dir), cb, {TraceEntries_pb2.TRACE_FORK}).walk_tree()
+
+        # OS info entries are not passed to the callback, but still update the state
+        self.assertEqual(seen, [(0, 1), (0, 3), (1, 2)])
+
+    def test_parse_multi_node(self):
+        os.remove(os.path.join(self._results_dir, 'ExecutionTracer.dat'))
+
+        # Nodes must be ordered by id, not by name
+        for node_id, kernel_start in ((10, 2), (2, 1)):
+            os.mkdir(os.path.join(self._results_dir, str(node_id)))
+            with open(os.path.join(self._results_dir, str(node_id), 'ExecutionTracer.dat'), 'wb') as fp:
+                fp.write(_os_info(0, kernel_start))
+
+        trace = _summarize(parse(self._results_dir))
+        self.assertEqual(trace, [1, 2])
+
+    def test_parse_unknown_entries(self):
+        entries = [
+            _os_info(0, 1),
+            _make_entry(0, TraceEntries_pb2.TRACE_CACHE_SIM_ENTRY, TraceEntries_pb2.PbTraceOsInfo(kernel_start=2)),
+            _os_info(0, 3),
+        ]
+
+        with open(os.path.join(self._results_dir, 'ExecutionTracer.dat'), 'wb') as fp:
+            fp.write(b''.join(entries))
+
+        with self.assertLogs('execution_trace', 'WARNING'):
+            trace = _summarize(parse(self._results_dir))
+        self.assertEqual(trace, [1, 3])
+
+    def test_parse_lazy_entries(self):
+        with open(os.path.join(self._results_dir, 'ExecutionTracer.dat'), 'wb') as fp:
+            fp.write(_make_entry(0, TraceEntries_pb2.TRACE_ICOUNT, TraceEntries_pb2.PbTraceInstructionCount(count=42)))
+
+        _, item = parse(self._results_dir)[0]
+        self.assertIsInstance(item, LazyTraceEntry)
+        self.assertEqual(item.count, 42)
+
+        # The entry must behave like the decoded item
+        message = TraceEntries_pb2.PbTraceInstructionCount(count=42)
+        self.assertIsInstance(item, TraceEntries_pb2.PbTraceInstructionCount)
+        self.assertEqual(item, message)
+        self.assertEqual(message, item)
+        self.assertNotEqual(item, TraceEntries_pb2.PbTraceInstructionCount(count=1))
+        self.assertEqual(repr(item), repr(message))
+
+        for copy_function in (copy.copy, copy.deepcopy):
+            item_copy = copy_function(parse(self._results_dir)[0][1])
+            self.assertIs(type(item_copy), TraceEntries_pb2.PbTraceInstructionCount)
+            self.assertEqual(item_copy, message)
+
+    def test_parse_pseudo_fork(self):
+        with open(os.path.join(self._results_dir, 'ExecutionTracer.dat'), 'wb') as fp:
+            fp.write(_fork(0) + _os_info(0, 1))
+
+        trace = _summarize(parse(self._results_dir))
+        self.assertEqual(trace, [{}, 1])